@@ -0,0 +1,256 @@
+import re
+import time
+
+from collections import namedtuple
+
+
+QueryShape = namedtuple("QueryShape", ["table",
+                                       "columns",
+                                       "queries",
+                                       "seconds"])
+
+IndexRecommendation = namedtuple("IndexRecommendation", ["table",
+                                                         "columns",
+                                                         "queries",
+                                                         "seconds",
+                                                         "sql",
+                                                         "sample"])
+
+IndexResult = namedtuple("IndexResult", ["recommendation",
+                                         "seconds_before",
+                                         "seconds_after",
+                                         "error"])
+
+
+_CLAUSE_END = r"(?:\s+GROUP\s+BY\b|\s+ORDER\s+BY\b|\s+LIMIT\b|;|$)"
+_FROM_RE = re.compile(r"\bFROM\s+(.+?)(?:\s+WHERE\b|%s)" % _CLAUSE_END,
+                      re.I | re.S)
+_WHERE_RE = re.compile(r"\bWHERE\s+(.+?)%s" % _CLAUSE_END, re.I | re.S)
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+_OPERATORS = r"(=|<>|!=|<=|>=|<|>|\s(?:NOT\s+)?LIKE\b|\sIN\b|" \
+             r"\sIS\s+NOT\b|\sIS\b|\sBETWEEN\b)"
+_LEFT_RE = re.compile(r"(?:(\w+)\.)?([A-Za-z_]\w*)\s*" + _OPERATORS, re.I)
+_RIGHT_RE = re.compile(_OPERATORS + r"\s*(\w+)\.([A-Za-z_]\w*)", re.I)
+_EQUALITY_OPERATORS = ("=", "IN", "IS")
+# Negated comparisons match most of the table; an index won't help.
+_UNINDEXABLE_OPERATORS = ("<>", "!=", "IS NOT", "NOT LIKE")
+_BOOLEAN_RE = re.compile(r"\b(AND|OR)\b", re.I)
+_KEYWORDS = frozenset(["AND", "OR", "NOT", "NULL"])
+_SYSTEM_PREFIXES = ("sqlite_", "pg_")
+
+
+def parse_predicates(sql):
+    """Return (tables, predicates) filtered on by a SELECT statement.
+
+    Each predicate is a (qualifier, column, is_equality) triple where
+    qualifier is the table name the column was prefixed with, or None.
+    This is a best-effort match against the SQL hilda generates, not a
+    general SQL parser.
+    """
+    from_match = _FROM_RE.search(sql)
+    if from_match is None:
+        return (), ()
+    tables = tuple(sorted(t.split()[0] for t in from_match.group(1).split(",")
+                          if t.strip()))
+    where_match = _WHERE_RE.search(sql)
+    if where_match is None:
+        return tables, ()
+    where = _LITERAL_RE.sub("?", where_match.group(1))
+    predicates = set()
+    for term in _conjuncts(where):
+        for qualifier, column, op in _LEFT_RE.findall(term):
+            if column.upper() not in _KEYWORDS:
+                _add_predicate(predicates, qualifier or None, column, op)
+        for op, qualifier, column in _RIGHT_RE.findall(term):
+            if not qualifier.isdigit():
+                _add_predicate(predicates, qualifier, column, op)
+    return tables, tuple(sorted(predicates))
+
+
+def _add_predicate(predicates, qualifier, column, op):
+    op = " ".join(op.split()).upper()
+    if op not in _UNINDEXABLE_OPERATORS:
+        predicates.add((qualifier, column, op in _EQUALITY_OPERATORS))
+
+
+def _depths(s):
+    depth = 0
+    result = []
+    for c in s:
+        if c == ")":
+            depth -= 1
+        result.append(depth)
+        if c == "(":
+            depth += 1
+    return result
+
+
+def _conjuncts(where):
+    # Split a WHERE clause into the terms AND'ed together at its top
+    # level, flattening parenthesized groups.  Terms OR'ed together
+    # can't share an index, so a disjunction contributes nothing.
+    where = where.strip()
+    depths = _depths(where)
+    while where.startswith("(") and \
+            all(d > 0 for d in depths[1:-1]) and where.endswith(")"):
+        where = where[1:-1].strip()
+        depths = _depths(where)
+    terms = []
+    start = 0
+    for match in _BOOLEAN_RE.finditer(where):
+        if depths[match.start()] != 0:
+            continue
+        if match.group(1).upper() == "OR":
+            return []
+        terms.append(where[start:match.start()])
+        start = match.end()
+    if not terms:
+        return [where]
+    terms.append(where[start:])
+    result = []
+    for term in terms:
+        result.extend(_conjuncts(term))
+    return result
+
+
+def _index_columns(predicates):
+    # Equality columns lead; an index can only use one range column
+    # after them.
+    equality = sorted(set(c for c, is_eq in predicates if is_eq))
+    ranges = sorted(set(c for c, is_eq in predicates
+                        if not is_eq and c not in equality))
+    return tuple(equality + ranges[:1]), len(equality)
+
+
+def _is_covered(columns, equality_count, indexes):
+    leading = set(columns[:equality_count])
+    for index in indexes:
+        if set(index[:equality_count]) != leading:
+            continue
+        if len(columns) == equality_count or \
+                index[equality_count:equality_count + 1] == columns[-1:]:
+            return True
+    return False
+
+
+class QueryRecorder(object):
+    """Records the shape of queries run through a Database.
+
+    Enable with Database.record_queries().  A shape is the table
+    queried together with the columns its WHERE clause filters on;
+    for each shape the recorder keeps how often it ran, the cumulative
+    time spent and the last statement seen so it can be replayed.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.stats = {}
+
+    def record(self, sql, params, seconds):
+        key = parse_predicates(sql)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = [0, 0.0, None]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = (sql, params)
+
+    def reset(self):
+        self.stats = {}
+
+    def _table_shapes(self):
+        # Resolve each recorded statement to per-table column sets,
+        # attributing unqualified columns to whichever of the statement's
+        # tables has a column of that name.
+        table_map = self.database._get_table_map()
+        shapes = {}
+        for (tables, predicates), (count, seconds, sample) in \
+                self.stats.items():
+            for table_name in tables:
+                table = table_map.get(table_name)
+                if table is None or table_name.startswith(_SYSTEM_PREFIXES):
+                    continue
+                names = set(c.name for c in table.columns())
+                used = [(column, is_eq)
+                        for qualifier, column, is_eq in predicates
+                        if qualifier == table_name or
+                        (qualifier is None and column in names)]
+                if not used:
+                    continue
+                columns, equality_count = _index_columns(used)
+                key = (table_name, columns, equality_count)
+                entry = shapes.setdefault(key, [0, 0.0, None, -1.0])
+                entry[0] += count
+                entry[1] += seconds
+                if seconds > entry[3]:
+                    entry[2] = sample
+                    entry[3] = seconds
+        return shapes
+
+    def shapes(self):
+        """Return recorded QueryShapes, most expensive first."""
+        result = [QueryShape(table, columns, count, seconds)
+                  for (table, columns, _), (count, seconds, _, _)
+                  in self._table_shapes().items()]
+        result.sort(key=lambda s: (-s.seconds, -s.queries, s.table))
+        return result
+
+    def recommend_indexes(self):
+        """Return IndexRecommendations for shapes no index covers.
+
+        Recommendations are ranked by the cumulative time spent in the
+        queries they would serve.
+        """
+        indexes = {}
+        result = []
+        for (table, columns, equality_count), (count, seconds, sample, _) \
+                in self._table_shapes().items():
+            if table not in indexes:
+                indexes[table] = self.database.indexes(table)
+            if _is_covered(columns, equality_count, indexes[table]):
+                continue
+            name = "%s_%s_idx" % (table, "_".join(columns))
+            sql = "CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (
+                name, table, ", ".join(columns))
+            result.append(IndexRecommendation(table, columns, count,
+                                              seconds, sql, sample))
+        result.sort(key=lambda r: (-r.seconds, -r.queries, r.table))
+        return result
+
+    def _time_sample(self, sample, repeat):
+        sql, params = sample
+        cursor = self.database.driver.cursor()
+        started = time.time()
+        for _ in xrange(repeat):
+            cursor.execute(sql, params)
+            cursor.fetchall()
+        return (time.time() - started) / repeat
+
+    def create_indexes(self, recommendations=None, repeat=3):
+        """Create recommended indexes, timing each one's sample query.
+
+        Defaults to every current recommendation.  The connection is
+        committed after each index is created, and rolled back if
+        creating one fails, so commit or roll back any pending work
+        first.  Returns an IndexResult per recommendation with the
+        sample query's average time before and after the index was
+        created, or the error raised creating it.
+        """
+        if recommendations is None:
+            recommendations = self.recommend_indexes()
+        driver = self.database.driver
+        error_type = getattr(driver, "Error", Exception)
+        results = []
+        for recommendation in recommendations:
+            before = self._time_sample(recommendation.sample, repeat)
+            cursor = driver.cursor()
+            try:
+                cursor.execute(recommendation.sql)
+                driver.commit()
+            except error_type, e:
+                driver.rollback()
+                results.append(IndexResult(recommendation, before, None, e))
+                continue
+            after = self._time_sample(recommendation.sample, repeat)
+            results.append(IndexResult(recommendation, before, after, None))
+        return results
@@ -1,11 +1,19 @@
 import operator
 import copy
+import re
+import time
 
 from collections import namedtuple
+from contextlib import contextmanager
+
+from hilda import loader
+
+from hilda.advisor import QueryRecorder
 
 from hilda.memoizer import memoize
 from hilda.memoizer import unmemoize_instance
 
+from hilda.exceptions import HildaException
 from hilda.exceptions import NoResultFound
 from hilda.exceptions import TooManyResultsFound
 
@@ -32,10 +40,15 @@ def _bind_selection(op):
 
 class Column(object):
 
-    def __init__(self, name, table, alias=None):
+    def __init__(self, name, table, alias=None, type_name=None,
+                 not_null=False, primary_key=False, default=None):
         self.name = name
         self.table = table
         self.alias = alias
+        self.type_name = type_name
+        self.not_null = not_null
+        self.primary_key = primary_key
+        self.default = default
 
     __eq__ = _bind_selection("=")
     __ne__ = _bind_selection("<>")
@@ -53,6 +66,21 @@ class Column(object):
     def aliased_name(self):
         return self.alias or self.name
 
+    @property
+    def qualified_name(self):
+        return "%s.%s" % (self.table.name, self.name)
+
+
+def _as_column_list(columns):
+    if columns is None:
+        return []
+    if isinstance(columns, Column):
+        return [columns]
+    return list(columns)
+
+
+AGGREGATE_FUNCTIONS = ("sum", "min", "max", "avg")
+
 
 class SelectMixin(object):
 
@@ -67,15 +95,7 @@ class SelectMixin(object):
     def select(self, what="*", where=None, limit=None):
         cursor = self.get_cursor()
         sql = "SELECT %s FROM %s" % (what, self._tables_clause())
-        base_where = self._base_where
-        if base_where or where:
-            sql += " WHERE "
-        if base_where:
-            sql += base_where
-        if where:
-            if base_where:
-                sql += " AND "
-            sql += where
+        sql += self._where_clause(where)
         if limit:
             sql += " LIMIT %d" + limit
         return map(self.record._make, self.fetchall(cursor, sql))
@@ -103,20 +123,95 @@ class SelectMixin(object):
             raise TooManyResultsFound
         return results[0]
 
-    def count(self, where=None):
+    def _where_clause(self, where=None):
+        base_where = self._base_where
+        clauses = [clause for clause in (base_where, where) if clause]
+        if not clauses:
+            return ""
+        return " WHERE " + " AND ".join(clauses)
+
+    def _approximate_count(self):
+        return None
+
+    def count(self, where=None, approximate=False):
+        """Count rows, optionally restricted by a textual where clause.
+
+        With approximate=True the count is read from the database's
+        planner statistics instead of scanning the table.  If no
+        statistics are available an exact count is performed instead.
+        """
+        if approximate:
+            if where:
+                raise HildaException("Approximate counts cannot be "
+                                     "combined with a where clause.")
+            estimate = self._approximate_count()
+            if estimate is not None:
+                return estimate
         cursor = self.get_cursor()
         sql = "SELECT COUNT(*) FROM %s" % self._tables_clause()
-        base_where = self._base_where
-        if base_where or where:
-            sql += " WHERE "
-        if base_where:
-            sql += base_where
-        if where:
-            if base_where:
-                sql += " AND "
-            sql += where
+        sql += self._where_clause(where)
         return self.fetchone(cursor, sql)[0]
 
+    def aggregate(self, group_by=None, where=None, count=False, **kwargs):
+        """Compute aggregates in the database with a single GROUP BY query.
+
+        group_by and each of sum, min, max and avg take a Column or a
+        list of Columns.  Returns a list of records whose fields are the
+        grouped columns' (aliased) names followed by "<function>_<name>"
+        for each aggregate, plus "count" when count=True.  Unaliased
+        columns whose names would clash, e.g. the same column name from
+        two tables of a Join, are prefixed with their table's name.
+        """
+        for function in kwargs:
+            if function not in AGGREGATE_FUNCTIONS:
+                raise TypeError("Unknown aggregate function: %s" % function)
+        group_columns = _as_column_list(group_by)
+        selected = [(None, c) for c in group_columns]
+        for function in AGGREGATE_FUNCTIONS:
+            for column in _as_column_list(kwargs.get(function)):
+                selected.append((function, column))
+        if not count and len(selected) == len(group_columns):
+            raise HildaException("At least one aggregate is required.")
+
+        clashes = set()
+        seen = set()
+        for function, column in selected:
+            key = (function, column.aliased_name)
+            if key in seen:
+                clashes.add(key)
+            seen.add(key)
+
+        expressions = []
+        fields = []
+        for function, column in selected:
+            name = column.aliased_name
+            if column.alias is None and (function, name) in clashes:
+                name = "%s_%s" % (column.table.name, name)
+            if function is None:
+                expressions.append(column.qualified_name)
+                fields.append(name)
+            else:
+                expressions.append("%s(%s)" % (function.upper(),
+                                               column.qualified_name))
+                fields.append("%s_%s" % (function, name))
+        if count:
+            expressions.append("COUNT(*)")
+            fields.append("count")
+        if len(set(fields)) != len(fields):
+            raise HildaException("Duplicate aggregate field names in %s; "
+                                 "alias the columns to disambiguate." %
+                                 ", ".join(fields))
+
+        cursor = self.get_cursor()
+        sql = "SELECT %s FROM %s" % (", ".join(expressions),
+                                     self._tables_clause())
+        sql += self._where_clause(where)
+        if group_columns:
+            sql += " GROUP BY " + ", ".join([c.qualified_name
+                                             for c in group_columns])
+        record = namedtuple("%sAggregate" % self._namedtuple_name(), fields)
+        return map(record._make, self.fetchall(cursor, sql))
+
 
 class Table(SelectMixin):
 
@@ -138,12 +233,23 @@ class Table(SelectMixin):
     def _tables_clause(self):
         return self.name
 
+    def _namedtuple_name(self):
+        return self.name.title()
+
+    def _approximate_count(self):
+        return self.database.approximate_count(self.name)
+
     @memoize
     def columns(self):
         cursor = self.get_cursor()
         cursor.execute("PRAGMA table_info(%s)" % self.name)
         rows = cursor.fetchall()
-        return [Column(row[1], self) for row in rows]
+        return [Column(row[1], self,
+                       type_name=row[2],
+                       not_null=bool(row[3]),
+                       primary_key=bool(row[5]),
+                       default=row[4])
+                for row in rows]
 
     def _make_column_property(self):
         columns = self.columns()
@@ -164,6 +270,27 @@ class Table(SelectMixin):
                                                    value_template)
         return cursor.execute(sql, kwargs)
 
+    def load_csv(self, path, encoding="utf-8", csv_options=None, **kwargs):
+        """Stream a CSV file with a header row into this table.
+
+        csv_options is a dict of csv.DictReader arguments such as
+        delimiter or quotechar.  Other keyword arguments are passed to
+        hilda.loader.load_rows; returns its LoadReport.
+        """
+        with open(path, "rb") as f:
+            rows = loader.iter_csv(f, encoding, **(csv_options or {}))
+            return loader.load_rows(self, rows, **kwargs)
+
+    def load_jsonl(self, path, encoding="utf-8", **kwargs):
+        """Stream a file of one JSON object per line into this table.
+
+        Keyword arguments are passed to hilda.loader.load_rows; returns
+        its LoadReport.
+        """
+        with open(path, "rb") as f:
+            return loader.load_rows(self, loader.iter_jsonl(f, encoding),
+                                    **kwargs)
+
     @memoize
     def _make_record(self):
         return namedtuple("%sRecord" % self.name.title(),
@@ -176,10 +303,15 @@ class Database(object):
 
     def __init__(self, driver):
         self.driver = driver
+        self.recorder = None
 
     def tables(self):
         raise NotImplementedError("Subclasses must implement.")
 
+    def indexes(self, table_name):
+        """Return the column name tuples of a table's indexes."""
+        raise NotImplementedError("Subclasses must implement.")
+
     def _get_table_map(self):
         # TODO: memoize maybe, etc. once this is finalized.  Also need
         # to handle schema.name etc
@@ -198,13 +330,60 @@ class Database(object):
         assert len(kwargs) == 0 or (len(kwargs) == 1 and "aliases" in kwargs)
         return Join(self, args, aliases=kwargs.get("aliases"))
 
-    def fetchall(self, cursor, sql, **kwargs):
+    def in_transaction(self):
+        """Return whether a transaction is open, or None if unknown."""
+        return getattr(self.driver, "in_transaction", None)
+
+    def _check_no_transaction(self):
+        in_transaction = self.in_transaction()
+        if in_transaction:
+            raise HildaException("A transaction is open on this "
+                                 "connection; commit or roll back first.")
+        if in_transaction is None:
+            raise HildaException("Can't tell whether a transaction is "
+                                 "open on this connection.")
+
+    @contextmanager
+    def explicit_transactions(self):
+        """Leave transaction control to SQL statements within the block.
+
+        Yields a function to call to commit each unit of work done with
+        SAVEPOINTs inside the block.  Raises HildaException unless the
+        connection is known to have no transaction open, as the block
+        would otherwise commit or discard the caller's pending work.
+        """
+        self._check_no_transaction()
+        yield self.driver.commit
+
+    def record_queries(self):
+        """Start recording query shapes; returns the QueryRecorder."""
+        if self.recorder is None:
+            self.recorder = QueryRecorder(self)
+        return self.recorder
+
+    def stop_recording_queries(self):
+        self.recorder = None
+
+    def _fetch(self, cursor, sql, kwargs, fetch):
+        recorder = self.recorder
+        if recorder is None:
+            cursor.execute(sql, kwargs)
+            return fetch()
+        started = time.time()
         cursor.execute(sql, kwargs)
-        return cursor.fetchall()
+        result = fetch()
+        recorder.record(sql, kwargs, time.time() - started)
+        return result
+
+    def fetchall(self, cursor, sql, **kwargs):
+        return self._fetch(cursor, sql, kwargs, cursor.fetchall)
 
     def fetchone(self, cursor, sql, **kwargs):
-        cursor.execute(sql, kwargs)
-        return cursor.fetchone()
+        return self._fetch(cursor, sql, kwargs, cursor.fetchone)
+
+    def approximate_count(self, table_name):
+        """Return the planner's row estimate for a table, or None."""
+        raise NotImplementedError("Subclasses must implement.")
 
 
 class SQLLiteDatabase(Database):
@@ -220,6 +399,64 @@ class SQLLiteDatabase(Database):
         rows = self.fetchall(cursor, sql)
         return [Table(self, row[0]) for row in rows]
 
+    @contextmanager
+    def explicit_transactions(self):
+        if self.driver.isolation_level is None:
+            # In autocommit mode the caller manages transactions with
+            # SQL.  Releasing an outermost savepoint commits it, while
+            # inside the caller's BEGIN savepoints nest and the caller
+            # decides, so there is nothing left to commit here.
+            yield lambda: None
+            return
+        # Otherwise the sqlite3 module commits implicitly before
+        # statements like SAVEPOINT, so switch to autocommit mode for the
+        # block.  That too commits, hence the check.  Python 2's sqlite3
+        # can't report whether a transaction is open, so there the
+        # connection has to be in autocommit mode already.
+        self._check_no_transaction()
+        isolation_level = self.driver.isolation_level
+        self.driver.isolation_level = None
+        try:
+            yield lambda: None
+        finally:
+            self.driver.isolation_level = isolation_level
+
+    def approximate_count(self, table_name):
+        # sqlite_stat1 only exists once ANALYZE has been run.
+        cursor = self.driver.cursor()
+        row = self.fetchone(cursor, """
+            SELECT name FROM sqlite_master
+            WHERE type='table' AND name='sqlite_stat1'
+        """)
+        if row is None:
+            return None
+        # The first integer of each stat row is the table's row count;
+        # every index on the table carries its own copy of it.
+        row = self.fetchone(cursor, """
+            SELECT stat FROM sqlite_stat1
+            WHERE tbl = :table_name
+            LIMIT 1
+        """, table_name=table_name)
+        if row is None or not row[0]:
+            return None
+        return int(row[0].split()[0])
+
+    def indexes(self, table_name):
+        cursor = self.driver.cursor()
+        result = []
+        # An INTEGER PRIMARY KEY is the rowid, which index_list doesn't
+        # report.
+        primary_key = [c.name for c in self.get_table(table_name).columns()
+                       if c.primary_key]
+        if len(primary_key) == 1:
+            result.append(tuple(primary_key))
+        cursor.execute("PRAGMA index_list(%s)" % table_name)
+        for index in cursor.fetchall():
+            cursor.execute("PRAGMA index_info(%s)" % index[1])
+            result.append(tuple(row[2] for row in
+                                sorted(cursor.fetchall())))
+        return result
+
 
 class PostgresDatabase(Database):
 
@@ -235,6 +472,50 @@ class PostgresDatabase(Database):
         rows = cursor.fetchall()
         return [Table(self, row[0]) for row in rows]
 
+    def in_transaction(self):
+        get_transaction_status = getattr(self.driver,
+                                         "get_transaction_status", None)
+        if get_transaction_status is None:
+            return None
+        # psycopg2's TRANSACTION_STATUS_IDLE
+        return get_transaction_status() != 0
+
+    def approximate_count(self, table_name):
+        cursor = self.driver.cursor()
+        # TODO: Schema support.
+        cursor.execute("""
+            SELECT c.reltuples, c.relpages
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'public' AND c.relname = %(table_name)s
+        """, {"table_name": table_name})
+        row = cursor.fetchone()
+        if row is None or row[0] is None:
+            return None
+        reltuples, relpages = row
+        # Until a table has been vacuumed or analyzed reltuples is -1 on
+        # PostgreSQL 14 and later, and 0 with relpages 0 before that.
+        if reltuples < 0 or (reltuples == 0 and relpages == 0):
+            return None
+        return int(reltuples)
+
+    def indexes(self, table_name):
+        cursor = self.driver.cursor()
+        # TODO: Schema support.
+        cursor.execute("""
+            SELECT indexdef
+            FROM pg_indexes
+            WHERE schemaname = 'public' AND tablename = %(table_name)s
+        """, {"table_name": table_name})
+        result = []
+        for row in cursor.fetchall():
+            # e.g. CREATE INDEX foo_idx ON public.foo USING btree (a, b)
+            match = re.search(r"USING \w+ \(([^)]*)\)", row[0])
+            if match:
+                result.append(tuple(c.split()[0].strip('"')
+                                    for c in match.group(1).split(",")))
+        return result
+
 
 class Alias(object):
 
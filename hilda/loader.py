@@ -0,0 +1,308 @@
+import csv
+import json
+import sys
+import threading
+import time
+
+from Queue import Queue
+from Queue import Full
+
+from collections import namedtuple
+
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_QUEUE_SIZE = 4
+
+_END = object()
+
+
+LoadReport = namedtuple("LoadReport", ["rows_loaded",
+                                       "rows_rejected",
+                                       "seconds",
+                                       "rows_per_second"])
+
+
+def _make_report(loaded, rejected, started):
+    seconds = time.time() - started
+    if seconds > 0:
+        rate = loaded / seconds
+    else:
+        rate = float(loaded)
+    return LoadReport(loaded, rejected, seconds, rate)
+
+
+def _affinity(type_name):
+    # Follows SQLite's column affinity rules, see
+    # http://www.sqlite.org/datatype3.html
+    type_name = (type_name or "").upper()
+    if "INT" in type_name:
+        return "integer"
+    if "CHAR" in type_name or "CLOB" in type_name or "TEXT" in type_name:
+        return "text"
+    if "BLOB" in type_name or not type_name:
+        return "blob"
+    if "REAL" in type_name or "FLOA" in type_name or "DOUB" in type_name:
+        return "real"
+    return "numeric"
+
+
+def _to_integer(value):
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError("%r is not an integer" % value)
+        return int(value)
+    return int(value)
+
+
+def _to_numeric(value):
+    # Like SQLite's NUMERIC affinity, text that isn't a number (dates,
+    # booleans spelt out, ...) is stored unchanged.
+    try:
+        return _to_integer(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _to_text(value):
+    if isinstance(value, (int, long, float)):
+        return unicode(value)
+    if not isinstance(value, basestring):
+        raise ValueError("%r is not text" % (value,))
+    return value
+
+
+COERCERS = {
+    "integer": _to_integer,
+    "real": float,
+    "numeric": _to_numeric,
+    "text": _to_text,
+    "blob": lambda value: value,
+}
+
+
+def make_coercer(columns):
+    """Return a function validating and coercing a row dict in place.
+
+    The returned function raises ValueError describing the first
+    problem it finds.
+    """
+    by_name = dict((c.name, (c, COERCERS[_affinity(c.type_name)]))
+                   for c in columns)
+    not_null = [c for c in columns if c.not_null and not c.primary_key]
+    # Columns with a default may be left out; the database fills them in.
+    required = [c.name for c in not_null if c.default is None]
+    non_nullable = [c.name for c in not_null]
+
+    def coerce(row):
+        for name in required:
+            if name not in row:
+                raise ValueError("%s may not be null" % name)
+        for name in non_nullable:
+            if name in row and row[name] is None:
+                raise ValueError("%s may not be null" % name)
+        for name, value in row.items():
+            if name not in by_name:
+                raise ValueError("unknown column %s" % name)
+            if value is None:
+                continue
+            column, coercer = by_name[name]
+            if isinstance(value, (dict, list)):
+                raise ValueError("non-scalar value for %s %s" %
+                                 (column.type_name, name))
+            try:
+                row[name] = coercer(value)
+            except (TypeError, ValueError):
+                raise ValueError("invalid value %r for %s %s" %
+                                 (value, column.type_name, name))
+        return row
+
+    return coerce
+
+
+def iter_csv(f, encoding="utf-8", **kwargs):
+    """Yield (line_number, row) pairs from a CSV file with a header.
+
+    Empty fields are read as NULL.
+    """
+    reader = csv.DictReader(f, **kwargs)
+    for row in reader:
+        if None in row or None in row.values():
+            yield reader.line_num, ValueError("wrong number of fields")
+            continue
+        try:
+            parsed = dict((name.decode(encoding),
+                           value.decode(encoding) or None)
+                          for name, value in row.items())
+        except UnicodeDecodeError, e:
+            parsed = e
+        yield reader.line_num, parsed
+
+
+def iter_jsonl(f, encoding="utf-8"):
+    """Yield (line_number, row) pairs from a file of JSON objects.
+
+    Blank lines are skipped.
+    """
+    for line_number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line, encoding=encoding)
+        except ValueError, e:
+            row = e
+        else:
+            if not isinstance(row, dict):
+                row = ValueError("expected a JSON object")
+        yield line_number, row
+
+
+def _produce(rows, queue, batch_size, stop):
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    try:
+        batch = []
+        for item in rows:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                put(batch)
+                batch = []
+                if stop.is_set():
+                    return
+        if batch:
+            put(batch)
+        put(_END)
+    except Exception:
+        put(sys.exc_info())
+
+
+def _iter_batches(rows, batch_size, queue_size):
+    # Parsing happens on a producer thread while the caller's thread,
+    # which owns the database connection, does the writing.  The queue
+    # is bounded so memory use stays flat regardless of file size.
+    queue = Queue(queue_size)
+    stop = threading.Event()
+    producer = threading.Thread(target=_produce,
+                                args=(rows, queue, batch_size, stop))
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is _END:
+                return
+            if isinstance(item, tuple):
+                raise item[0], item[1], item[2]
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def _insert_sql(table_name, columns):
+    return "INSERT INTO %s (%s) VALUES (%s)" % (
+        table_name,
+        ", ".join(columns),
+        ", ".join(":" + column for column in columns))
+
+
+def _write_batch(cursor, table_name, groups, integrity_error, reject):
+    try:
+        for columns, group in groups.items():
+            cursor.executemany(_insert_sql(table_name, columns),
+                               [row for _, row in group])
+        return sum(len(group) for group in groups.values())
+    except Exception, e:
+        if integrity_error is None or not isinstance(e, integrity_error):
+            raise
+    # Replay the batch a row at a time to find the rows violating
+    # constraints without losing the good ones.
+    cursor.execute("ROLLBACK TO SAVEPOINT hilda_load_batch")
+    loaded = 0
+    for columns, group in groups.items():
+        sql = _insert_sql(table_name, columns)
+        for line_number, row in group:
+            cursor.execute("SAVEPOINT hilda_load_row")
+            try:
+                cursor.execute(sql, row)
+                loaded += 1
+            except integrity_error, e:
+                cursor.execute("ROLLBACK TO SAVEPOINT hilda_load_row")
+                reject(line_number, row, str(e))
+            cursor.execute("RELEASE SAVEPOINT hilda_load_row")
+    return loaded
+
+
+def load_rows(table, rows, batch_size=DEFAULT_BATCH_SIZE,
+              queue_size=DEFAULT_QUEUE_SIZE, on_reject=None, progress=None):
+    """Stream (line_number, row) pairs into table.
+
+    Each batch is coerced against table.columns(), written with
+    executemany inside a savepoint and committed as its own transaction,
+    unless the load runs inside a transaction the caller opened on a
+    connection in autocommit mode; then committing is left to the
+    caller.  Raises HildaException if the connection may have another
+    transaction open, see Database.explicit_transactions.
+
+    Rows that fail validation, or violate a constraint, are skipped and
+    passed to on_reject(line_number, row, reason).  progress, if given,
+    is called with a LoadReport after every batch.
+    """
+    database = table.database
+    integrity_error = getattr(database.driver, "IntegrityError", None)
+    started = time.time()
+    state = {"loaded": 0, "rejected": 0}
+
+    def reject(line_number, row, reason):
+        state["rejected"] += 1
+        if on_reject is not None:
+            on_reject(line_number, row, reason)
+
+    with database.explicit_transactions() as commit:
+        coerce = make_coercer(table.columns())
+        cursor = table.get_cursor()
+        for batch in _iter_batches(rows, batch_size, queue_size):
+            # Rows in a batch may name different columns (JSONL
+            # especially), so group them by column set to keep one
+            # statement per group.
+            groups = {}
+            for line_number, row in batch:
+                if isinstance(row, Exception):
+                    reject(line_number, None, str(row))
+                    continue
+                try:
+                    coerce(row)
+                except ValueError, e:
+                    reject(line_number, row, str(e))
+                    continue
+                key = tuple(sorted(row.keys()))
+                groups.setdefault(key, []).append((line_number, row))
+
+            cursor.execute("SAVEPOINT hilda_load_batch")
+            try:
+                loaded = _write_batch(cursor, table.name, groups,
+                                      integrity_error, reject)
+            except:
+                cursor.execute("ROLLBACK TO SAVEPOINT hilda_load_batch")
+                cursor.execute("RELEASE SAVEPOINT hilda_load_batch")
+                raise
+            cursor.execute("RELEASE SAVEPOINT hilda_load_batch")
+            commit()
+            state["loaded"] += loaded
+
+            if progress is not None:
+                progress(_make_report(state["loaded"],
+                                      state["rejected"],
+                                      started))
+
+    return _make_report(state["loaded"], state["rejected"], started)
@@ -1,10 +1,18 @@
 #!/usr/bin/env python
-import unittest
+import os
+import shutil
 import sqlite3
+import tempfile
+import unittest
 
 from hilda.core import SQLLiteDatabase as Database
 from hilda.core import Selection
 
+from hilda import loader
+
+from hilda.advisor import parse_predicates
+
+from hilda.exceptions import HildaException
 from hilda.exceptions import NoResultFound
 from hilda.exceptions import TooManyResultsFound
 
@@ -336,6 +344,430 @@ class DatabaseTests(unittest.TestCase):
         episodes = episode_with_production.select()
         self.assertEqual(5, episode_with_production.count())
 
+    def _insert_episodes(self):
+        episodes = self.database.get_table("episodes")
+        productions = self.database.get_table("productions")
+
+        productions.insert(type=PRODUCTION_TYPE_TV_SHOW,
+                           name="Lost")
+        productions.insert(type=PRODUCTION_TYPE_TV_SHOW,
+                           name="Dexter")
+
+        lost = productions.select_one_where(name="Lost")
+        dexter = productions.select_one_where(name="Dexter")
+
+        for number, name in [(1, "Pilot, Part 1"),
+                             (2, "Pilot, Part 2"),
+                             (3, "Tabula Rasa")]:
+            episodes.insert(production_id=lost.id,
+                            season_number=1,
+                            episode_number=number,
+                            name=name)
+        for number, name in [(1, "Pilot"),
+                             (2, "Crocodile")]:
+            episodes.insert(production_id=dexter.id,
+                            season_number=1,
+                            episode_number=number,
+                            name=name)
+        return episodes, productions
+
+    def test_can_aggregate_a_table_without_grouping(self):
+        episodes, productions = self._insert_episodes()
+
+        results = episodes.aggregate(sum=episodes.c.episode_number,
+                                     max=episodes.c.episode_number,
+                                     count=True)
+        self.assertEqual(1, len(results))
+        self.assertEqual(9, results[0].sum_episode_number)
+        self.assertEqual(3, results[0].max_episode_number)
+        self.assertEqual(5, results[0].count)
+
+    def test_can_aggregate_a_table_with_group_by(self):
+        episodes, productions = self._insert_episodes()
+
+        results = episodes.aggregate(group_by=[episodes.c.production_id],
+                                     min=episodes.c.episode_number,
+                                     max=episodes.c.episode_number,
+                                     where="season_number = 1")
+        by_production = dict((r.production_id, r) for r in results)
+        self.assertEqual(2, len(by_production))
+        self.assertEqual((1, 1, 3), by_production[1])
+        self.assertEqual((2, 1, 2), by_production[2])
+
+    def test_can_aggregate_a_join_with_aliases(self):
+        episodes, productions = self._insert_episodes()
+
+        episode_with_production = self.database.create_join(\
+            episodes.c.production_id == productions.c.id)
+        results = episode_with_production.aggregate(
+            group_by=productions.c.name("production_name"),
+            avg=episodes.c.episode_number,
+            count=True)
+        by_name = dict((r.production_name, r) for r in results)
+        self.assertEqual(2.0, by_name["Lost"].avg_episode_number)
+        self.assertEqual(3, by_name["Lost"].count)
+        self.assertEqual(2, by_name["Dexter"].count)
+
+    def test_aggregate_prefixes_clashing_join_columns_with_table(self):
+        episodes, productions = self._insert_episodes()
+
+        episode_with_production = self.database.create_join(\
+            episodes.c.production_id == productions.c.id)
+        results = episode_with_production.aggregate(
+            group_by=[productions.c.name, episodes.c.season_number],
+            min=[episodes.c.name, productions.c.id],
+            max=episodes.c.id)
+        self.assertEqual(("name",
+                          "season_number",
+                          "min_name",
+                          "min_id",
+                          "max_id"),
+                         results[0]._fields)
+
+        results = episode_with_production.aggregate(
+            group_by=[productions.c.name, episodes.c.name],
+            max=[episodes.c.id, productions.c.id])
+        self.assertEqual(("productions_name",
+                          "episodes_name",
+                          "max_episodes_id",
+                          "max_productions_id"),
+                         results[0]._fields)
+        self.assertEqual(5, len(results))
+
+    def test_aggregate_rejects_unresolvable_duplicate_fields(self):
+        episodes = self.database.get_table("episodes")
+        self.assertRaises(HildaException,
+                          lambda: episodes.aggregate(
+                              sum=[episodes.c.episode_number,
+                                   episodes.c.episode_number]))
+
+    def test_aggregate_requires_an_aggregate(self):
+        episodes = self.database.get_table("episodes")
+        self.assertRaises(HildaException,
+                          lambda: episodes.aggregate(
+                              group_by=episodes.c.production_id))
+
+    def test_approximate_count_falls_back_without_statistics(self):
+        episodes, productions = self._insert_episodes()
+        self.assertEqual(5, episodes.count(approximate=True))
+
+    def test_approximate_count_reads_statistics(self):
+        episodes, productions = self._insert_episodes()
+        cursor = episodes.get_cursor()
+        cursor.execute("CREATE INDEX episodes_production_id "
+                       "ON episodes (production_id)")
+        cursor.execute("ANALYZE")
+        cursor.execute("UPDATE sqlite_stat1 SET stat = '1000 200' "
+                       "WHERE tbl = 'episodes'")
+        self.assertEqual(1000, episodes.count(approximate=True))
+        self.assertEqual(5, episodes.count())
+
+    def _use_autocommit_mode(self):
+        # Python 2's sqlite3 can't report whether a transaction is open,
+        # so loading needs the connection in autocommit mode.
+        self.tv_movie_db.isolation_level = None
+
+    def _write_temp_file(self, name, contents):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, name)
+        with open(path, "wb") as f:
+            f.write(contents)
+        return path
+
+    def test_can_load_csv_into_a_table(self):
+        self._use_autocommit_mode()
+        episodes = self.database.get_table("episodes")
+        path = self._write_temp_file("episodes.csv",
+                                     "production_id,season_number,"
+                                     "episode_number,name\n"
+                                     "1,1,1,\"Pilot, Part 1\"\n"
+                                     "1,,2,Pilot\xc2\xa0Part 2\n"
+                                     "1,1,three,Tabula Rasa\n"
+                                     "1,1\n"
+                                     "2,1,1,Pilot\n")
+        rejects = []
+        report = episodes.load_csv(path, batch_size=2,
+                                   on_reject=lambda *r: rejects.append(r))
+        self.assertEqual(3, report.rows_loaded)
+        self.assertEqual(2, report.rows_rejected)
+        self.assertEqual([4, 5], [line_number for line_number, _, _
+                                  in rejects])
+        self.assertEqual(3, episodes.count())
+
+        part2 = episodes.select_one_where(episode_number=2)
+        self.assertEqual(None, part2.season_number)
+        self.assertEqual(u"Pilot\xa0Part 2", part2.name)
+
+    def test_load_refuses_to_commit_pending_work(self):
+        characters = self.database.get_table("characters")
+        actors = self.database.get_table("actors")
+        characters.insert(name="Kate Austin")
+        path = self._write_temp_file("actors.jsonl",
+                                     '{"id": 1, "first_name": "Evangeline"}\n')
+        self.assertRaises(HildaException, lambda: actors.load_jsonl(path))
+        self.assertEqual("", self.tv_movie_db.isolation_level)
+
+        self.tv_movie_db.rollback()
+        self.assertEqual(0, characters.count())
+        self.assertEqual(0, actors.count())
+
+    def test_load_nests_inside_the_callers_transaction(self):
+        self._use_autocommit_mode()
+        characters = self.database.get_table("characters")
+        actors = self.database.get_table("actors")
+        cursor = self.tv_movie_db.cursor()
+        cursor.execute("BEGIN")
+        characters.insert(name="Kate Austin")
+        path = self._write_temp_file("actors.jsonl",
+                                     '{"id": 1, "first_name": "Evangeline"}\n'
+                                     '{"id": 1, "first_name": "Duplicate"}\n'
+                                     '{"id": 2, "first_name": "Matthew"}\n')
+        report = actors.load_jsonl(path, batch_size=2)
+        self.assertEqual((2, 1), report[:2])
+        self.assertEqual(1, characters.count())
+        self.assertEqual(2, actors.count())
+
+        cursor.execute("ROLLBACK")
+        self.assertEqual(0, characters.count())
+        self.assertEqual(0, actors.count())
+
+    def test_load_rolls_back_only_the_failing_batch(self):
+        self._use_autocommit_mode()
+        cursor = self.tv_movie_db.cursor()
+        cursor.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, body)")
+        self.database.forget()
+        notes = self.database.get_table("notes")
+        characters = self.database.get_table("characters")
+        cursor.execute("BEGIN")
+        characters.insert(name="Kate Austin")
+
+        def rows():
+            yield 1, {"body": "first"}
+            yield 2, {"body": "second"}
+            yield 3, {"body": "third"}
+            # The driver can't bind this, which isn't an IntegrityError.
+            yield 4, {"body": object()}
+
+        self.assertRaises(sqlite3.InterfaceError,
+                          lambda: loader.load_rows(notes, rows(),
+                                                   batch_size=2))
+        cursor.execute("COMMIT")
+        self.assertEqual(1, characters.count())
+        self.assertEqual(["first", "second"],
+                         [n.body for n in notes.select()])
+
+    def test_load_csv_accepts_csv_options(self):
+        self._use_autocommit_mode()
+        characters = self.database.get_table("characters")
+        path = self._write_temp_file("characters.csv",
+                                     "id;name\n"
+                                     "1;|Austin; Kate|\n")
+        report = characters.load_csv(path,
+                                     csv_options={"delimiter": ";",
+                                                  "quotechar": "|"})
+        self.assertEqual((1, 0), report[:2])
+        self.assertEqual((1, "Austin; Kate"),
+                         characters.select_one_where(id=1))
+
+    def test_load_csv_rejects_badly_encoded_rows(self):
+        self._use_autocommit_mode()
+        characters = self.database.get_table("characters")
+        path = self._write_temp_file("characters.csv",
+                                     "name\n"
+                                     "Kate Austin\n"
+                                     "bad\xff\n"
+                                     "Juliet Burke\n")
+        rejects = []
+        report = characters.load_csv(path, batch_size=10,
+                                     on_reject=lambda *r: rejects.append(r))
+        self.assertEqual((2, 1), report[:2])
+        self.assertEqual([3], [line_number for line_number, _, _
+                               in rejects])
+        self.assertEqual(["Kate Austin", "Juliet Burke"],
+                         [c.name for c in characters.select()])
+
+    def test_load_csv_keeps_text_in_numeric_columns(self):
+        self._use_autocommit_mode()
+        cursor = self.tv_movie_db.cursor()
+        cursor.execute("""CREATE TABLE airings (
+                              created DATE NOT NULL,
+                              rerun BOOLEAN,
+                              rating DECIMAL(3, 1)
+                          );""")
+        self.database.forget()
+        airings = self.database.get_table("airings")
+        path = self._write_temp_file("airings.csv",
+                                     "created,rerun,rating\n"
+                                     "2020-01-01,true,8.5\n"
+                                     "2020-01-02,0,7\n")
+        report = airings.load_csv(path)
+        self.assertEqual((2, 0), report[:2])
+        self.assertEqual([(u"2020-01-01", u"true", 8.5),
+                          (u"2020-01-02", 0, 7)],
+                         [tuple(a) for a in airings.select()])
+
+    def test_can_load_jsonl_into_a_table(self):
+        self._use_autocommit_mode()
+        characters = self.database.get_table("characters")
+        characters.insert(id=1, name="Kate Austin")
+        path = self._write_temp_file("characters.jsonl",
+                                     '{"name": "Juliet Burke"}\n'
+                                     '\n'
+                                     '{"id": 1, "name": "Duplicate"}\n'
+                                     '{"id": "7", "name": "Ben Linus"}\n'
+                                     '{"name": null}\n'
+                                     'not json\n')
+        progress = []
+        report = characters.load_jsonl(path, batch_size=10,
+                                       progress=progress.append)
+        self.assertEqual(2, report.rows_loaded)
+        self.assertEqual(3, report.rows_rejected)
+        self.assertEqual([report.rows_loaded],
+                         [p.rows_loaded for p in progress])
+        self.assertEqual(["Kate Austin", "Juliet Burke", "Ben Linus"],
+                         [c.name for c in characters.select()])
+        self.assertEqual(7, characters.select_one_where(name="Ben Linus").id)
+
+    def test_parse_predicates_finds_filtered_columns(self):
+        tables, predicates = parse_predicates(
+            "SELECT COUNT(*) FROM episodes, productions "
+            "WHERE (episodes.production_id = productions.id) "
+            "AND name = 'a = b' AND season_number > 1 LIMIT 2")
+        self.assertEqual(("episodes", "productions"), tables)
+        self.assertEqual(((None, "name", True),
+                          (None, "season_number", False),
+                          ("episodes", "production_id", True),
+                          ("productions", "id", True)),
+                         predicates)
+
+    def test_parse_predicates_ignores_or_terms(self):
+        tables, predicates = parse_predicates(
+            "SELECT * FROM episodes WHERE name = 'a' OR season_number = 1")
+        self.assertEqual(("episodes",), tables)
+        self.assertEqual((), predicates)
+
+        tables, predicates = parse_predicates(
+            "SELECT * FROM episodes WHERE (name = 'a' OR season_number = 1)"
+            " AND (production_id = 2 AND episode_number IN (1, 2))")
+        self.assertEqual(((None, "episode_number", True),
+                          (None, "production_id", True)),
+                         predicates)
+
+    def test_parse_predicates_ignores_is_not(self):
+        tables, predicates = parse_predicates(
+            "SELECT * FROM episodes WHERE name IS NOT NULL "
+            "AND season_number IS NULL AND production_id = 1")
+        self.assertEqual(((None, "production_id", True),
+                          (None, "season_number", True)),
+                         predicates)
+
+    def test_recorder_does_not_recommend_indexes_for_or(self):
+        episodes, productions = self._insert_episodes()
+        recorder = self.database.record_queries()
+        episodes.count(where="name = 'Pilot' OR season_number = 2")
+        episodes.count(where="name IS NOT NULL")
+        self.assertEqual([], recorder.shapes())
+        self.assertEqual([], recorder.recommend_indexes())
+
+    def test_recorder_recommends_indexes_for_uncovered_shapes(self):
+        episodes, productions = self._insert_episodes()
+        recorder = self.database.record_queries()
+
+        for _ in range(3):
+            episodes.select_where(production_id=1)
+        episodes.count(where="season_number = 1 AND episode_number > 1")
+        productions.select_where(id=1)
+        episode_with_production = self.database.create_join(\
+            episodes.c.production_id == productions.c.id)
+        episode_with_production.count()
+
+        shapes = dict(((s.table, s.columns), s.queries)
+                      for s in recorder.shapes())
+        self.assertEqual(4, shapes[("episodes", ("production_id",))])
+        self.assertEqual(1, shapes[("episodes", ("season_number",
+                                                 "episode_number"))])
+        self.assertEqual(2, shapes[("productions", ("id",))])
+
+        recommendations = recorder.recommend_indexes()
+        self.assertEqual([("episodes", ("production_id",)),
+                          ("episodes", ("season_number", "episode_number"))],
+                         sorted((r.table, r.columns)
+                                for r in recommendations))
+
+        results = recorder.create_indexes(recommendations, repeat=1)
+        self.assertEqual([None, None], [r.error for r in results])
+        self.assertEqual([], recorder.recommend_indexes())
+        self.assertEqual(5, episodes.count())
+
+    def test_create_indexes_reports_failures_and_carries_on(self):
+        episodes, productions = self._insert_episodes()
+        recorder = self.database.record_queries()
+        episodes.select_where(production_id=1)
+        productions.select_where(name="Lost")
+        first, second = sorted(recorder.recommend_indexes())
+        broken = first._replace(sql="CREATE INDEX broken ON nope (x)")
+
+        results = recorder.create_indexes([broken, second], repeat=1)
+        self.assertTrue(isinstance(results[0].error, sqlite3.Error))
+        self.assertEqual(None, results[0].seconds_after)
+        self.assertEqual(None, results[1].error)
+        self.assertEqual([first], recorder.recommend_indexes())
+
+        # Recreating an index that already exists isn't an error.
+        results = recorder.create_indexes([second], repeat=1)
+        self.assertEqual(None, results[0].error)
+
+    def test_queries_are_not_recorded_by_default(self):
+        characters = self.database.get_table("characters")
+        characters.select()
+        self.assertEqual(None, self.database.recorder)
+
+    def test_load_jsonl_leaves_out_not_null_columns_with_defaults(self):
+        self._use_autocommit_mode()
+        cursor = self.tv_movie_db.cursor()
+        cursor.execute("""CREATE TABLE tasks (
+                              id INTEGER PRIMARY KEY,
+                              name TEXT NOT NULL,
+                              status TEXT NOT NULL DEFAULT 'new'
+                          );""")
+        self.database.forget()
+        tasks = self.database.get_table("tasks")
+        path = self._write_temp_file("tasks.jsonl",
+                                     '{"name": "a"}\n'
+                                     '{"name": "b", "status": "done"}\n'
+                                     '{"name": "c", "status": null}\n'
+                                     '{"status": "done"}\n')
+        rejects = []
+        report = tasks.load_jsonl(path,
+                                  on_reject=lambda *r: rejects.append(r))
+        self.assertEqual((2, 2), report[:2])
+        self.assertEqual([(3, "status may not be null"),
+                          (4, "name may not be null")],
+                         [(line_number, reason) for line_number, _, reason
+                          in rejects])
+        self.assertEqual([("a", "new"), ("b", "done")],
+                         [(t.name, t.status) for t in tasks.select()])
+
+    def test_load_jsonl_rejects_nested_values(self):
+        self._use_autocommit_mode()
+        cursor = self.tv_movie_db.cursor()
+        cursor.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, body)")
+        self.database.forget()
+        notes = self.database.get_table("notes")
+        path = self._write_temp_file("notes.jsonl",
+                                     '{"body": "plain"}\n'
+                                     '{"body": {"nested": true}}\n'
+                                     '{"body": [1, 2]}\n'
+                                     '{"body": 3}\n')
+        rejects = []
+        report = notes.load_jsonl(path,
+                                  on_reject=lambda *r: rejects.append(r))
+        self.assertEqual((2, 2), report[:2])
+        self.assertEqual([2, 3], [line_number for line_number, _, _
+                                  in rejects])
+        self.assertEqual(2, notes.count())
+
     # TODO: Explicit tests for aliases at column level and in
     # create_join.  Also should add to all other select statement stuff.
 